@@ -3,7 +3,7 @@
 Example usage of Instagram Downloader
 """
 
-from instagram_downloader import InstagramDownloader
+from instagram_downloader import InstagramDownloader, AsyncInstagramDownloader
 
 # Initialize downloader
 downloader = InstagramDownloader()
@@ -35,9 +35,31 @@ urls = [
     'https://www.instagram.com/reel/XYZ789/',
 ]
 
+# Bind the method once instead of looking it up on every iteration
+get_media_info = downloader.get_media_info
+
 for url in urls:
     try:
-        media = downloader.get_media_info(url)
+        media = get_media_info(url)
         print(f"✓ {media['type']}: {url}")
     except Exception as e:
         print(f"✗ Error for {url}: {e}")
+
+print()
+
+# Example 3: Concurrent batch processing (requires: pip install aiohttp)
+print("Example 3: Concurrent batch processing")
+print("-" * 50)
+
+try:
+    async_downloader = AsyncInstagramDownloader()
+except ImportError as e:
+    print(f"Skipped: {e}")
+else:
+    results = async_downloader.download_many_sync(urls)
+
+    for url, result in zip(urls, results):
+        if isinstance(result, Exception):
+            print(f"✗ Error for {url}: {result}")
+        else:
+            print(f"✓ {result['type']}: {url}")
@@ -0,0 +1,423 @@
+import json
+import asyncio
+import threading
+import time
+import unittest
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import instagram_downloader
+from instagram_downloader import (
+    InstagramDownloader, RateLimitedError, ServerError, _AdaptiveLimiter,
+)
+
+
+IMAGE_URL = 'https://scontent.cdninstagram.com/v/t51/image.jpg'
+
+NODE = {'__typename': 'GraphImage', 'display_url': IMAGE_URL}
+
+SHARED_DATA = json.dumps(
+    {'entry_data': {'PostPage': [{'graphql': {'shortcode_media': NODE}}]}}
+)
+
+ADDITIONAL_DATA = json.dumps({'graphql': {'shortcode_media': NODE}})
+
+EXPECTED = {'type': 'image', 'url': IMAGE_URL, 'source': 'json'}
+
+# The marker shows up in code before the blob itself
+SHARED_DATA_GUARD_PAGE = (
+    '<html><head></head><body>'
+    '<script>if(window._sharedData){console.log("ready")}</script>'
+    '<script>window._sharedData = ' + SHARED_DATA + ';</script>'
+    '<p>' + 'filler ' * 2000 + '</p>'
+    '</body></html>'
+).encode()
+
+ADDITIONAL_DATA_DEFINITION_PAGE = (
+    '<html><head></head><body>'
+    '<script>window.__additionalDataLoaded = function(page,data)'
+    '{window.__additionalData[page] = data;}</script>'
+    "<script>window.__additionalDataLoaded('/p/ABC123/'," + ADDITIONAL_DATA
+    + ');</script>'
+    '</body></html>'
+).encode()
+
+LD_JSON = json.dumps({
+    '@type': 'VideoObject',
+    'video': [{'contentUrl': 'https://scontent.cdninstagram.com/v/t50/clip.mp4'}],
+    'thumbnailUrl': IMAGE_URL,
+})
+
+LD_JSON_EXPECTED = {
+    'type': 'video',
+    'url': 'https://scontent.cdninstagram.com/v/t50/clip.mp4',
+    'thumbnail': IMAGE_URL,
+    'source': 'json',
+}
+
+
+def chunked(data, size):
+    return (data[i:i + size] for i in range(0, len(data), size))
+
+
+class MarkerOccurrenceTest(unittest.TestCase):
+    """The blob is found even when its marker first appears elsewhere"""
+
+    def setUp(self):
+        self.downloader = InstagramDownloader(cache_size=0)
+
+    def tearDown(self):
+        self.downloader.close()
+
+    def test_shared_data_after_guard(self):
+        media = self.downloader._extract_media(SHARED_DATA_GUARD_PAGE)
+        self.assertEqual(media, EXPECTED)
+
+    def test_additional_data_after_definition(self):
+        media = self.downloader._extract_media(ADDITIONAL_DATA_DEFINITION_PAGE)
+        self.assertEqual(media, EXPECTED)
+
+    def test_streamed_page_read_whole_by_default(self):
+        page, media = self.downloader._read_html(
+            chunked(SHARED_DATA_GUARD_PAGE, 64)
+        )
+        self.assertIsNone(media)
+        self.assertEqual(page, SHARED_DATA_GUARD_PAGE)
+
+    def test_streamed_page_stops_after_blob(self):
+        self.downloader.early_stop = True
+        blob_end = SHARED_DATA_GUARD_PAGE.index(b';</script>') + 10
+        for size in (1, 7, 64, 4096, len(SHARED_DATA_GUARD_PAGE)):
+            with self.subTest(chunk_size=size):
+                page, media = self.downloader._read_html(
+                    chunked(SHARED_DATA_GUARD_PAGE, size)
+                )
+                self.assertEqual(media, EXPECTED)
+                self.assertLess(len(page), blob_end + size)
+                self.assertEqual(self.downloader._extract_media(page), EXPECTED)
+
+    def test_early_stop_keeps_fallback_for_bad_node(self):
+        self.downloader.early_stop = True
+        shared_data = json.dumps({'entry_data': {'PostPage': [
+            {'graphql': {'shortcode_media': {'__typename': {}}}}
+        ]}})
+        page = (
+            '<html><head><meta property="og:image" content="og.jpg">'
+            '</head><body><script>window._sharedData = ' + shared_data
+            + ';</script></body></html>'
+        ).encode()
+        html, media = self.downloader._read_html(chunked(page, 64))
+        self.assertIsNone(media)
+        self.assertEqual(
+            self.downloader._extract_media(html),
+            {'type': 'image', 'url': 'og.jpg', 'source': 'og_meta'}
+        )
+
+
+class PostPageItemTest(unittest.TestCase):
+    """Only the first PostPage entry counts, with or without ijson"""
+
+    def setUp(self):
+        self.downloader = InstagramDownloader(cache_size=0)
+
+    def tearDown(self):
+        self.downloader.close()
+
+    def extract(self, post_pages):
+        shared_data = json.dumps({'entry_data': {'PostPage': post_pages}})
+        page = (
+            '<html><head><meta property="og:image" content="og.jpg">'
+            '</head><body><script>window._sharedData = ' + shared_data
+            + ';</script></body></html>'
+        ).encode()
+        results = [self.downloader._extract_media(page)]
+        with mock.patch.object(instagram_downloader, 'ijson', None):
+            results.append(self.downloader._extract_media(page))
+        self.assertEqual(results[0], results[1])
+        return results[0]
+
+    def test_first_entry_without_media(self):
+        media = self.extract([
+            {'other': 1},
+            {'graphql': {'shortcode_media': NODE}},
+        ])
+        self.assertEqual(media['source'], 'og_meta')
+
+    def test_first_entry_wins(self):
+        second = dict(NODE, display_url='https://cdn/second.jpg')
+        media = self.extract([
+            {'graphql': {'shortcode_media': NODE}},
+            {'graphql': {'shortcode_media': second}},
+        ])
+        self.assertEqual(media, EXPECTED)
+
+
+class LdJsonCaseTest(unittest.TestCase):
+    """ld+json blocks are found whatever the casing of their markup"""
+
+    def setUp(self):
+        self.downloader = InstagramDownloader(cache_size=0)
+
+    def tearDown(self):
+        self.downloader.close()
+
+    def test_tag_casing(self):
+        for tag in (
+            '<script type="application/ld+json">',
+            '<SCRIPT TYPE="application/ld+json">',
+            '<script Type="application/ld+json">',
+            "<script type='application/LD+JSON'>",
+            '<Script defer type="Application/Ld+Json">',
+        ):
+            with self.subTest(tag=tag):
+                page = (
+                    '<html><head>' + tag + LD_JSON + '</script></head></html>'
+                ).encode()
+                self.assertEqual(
+                    self.downloader._try_ld_json(page), LD_JSON_EXPECTED
+                )
+
+    def test_probe_skips_other_json_types(self):
+        page = (
+            '<html><head><script>var t = "application/vnd.api+JSON";'
+            '</script><SCRIPT TYPE="application/ld+json">' + LD_JSON
+            + '</SCRIPT></head></html>'
+        ).encode()
+        self.assertEqual(self.downloader._try_ld_json(page), LD_JSON_EXPECTED)
+
+    def test_other_script_types_ignored(self):
+        page = (
+            '<html><head><SCRIPT TYPE="text/javascript">var t = '
+            '"application/ld+json";</SCRIPT></head></html>'
+        ).encode()
+        self.assertIsNone(self.downloader._try_ld_json(page))
+
+
+class AdaptiveLimiterTest(unittest.TestCase):
+    """Slots are handed out in arrival order and the limit adapts once"""
+
+    def test_fifo_hand_off(self):
+        async def run():
+            limiter = _AdaptiveLimiter(1, 1, 1)
+            order = []
+
+            async def job(name):
+                async with limiter.slot():
+                    order.append(name)
+                    await asyncio.sleep(0)
+
+            tasks = [asyncio.ensure_future(job(i)) for i in range(5)]
+            await asyncio.sleep(0)
+            # A newcomer queues behind the waiters instead of jumping in
+            tasks.append(asyncio.ensure_future(job(5)))
+            await asyncio.gather(*tasks)
+            return order, limiter
+
+        order, limiter = asyncio.run(run())
+        self.assertEqual(order, [0, 1, 2, 3, 4, 5])
+        self.assertEqual(limiter._in_flight, 0)
+        self.assertFalse(limiter._waiters)
+
+    def test_release_wakes_one_waiter_per_free_slot(self):
+        async def run():
+            limiter = _AdaptiveLimiter(2, 1, 2)
+            release = asyncio.Event()
+
+            async def job():
+                async with limiter.slot():
+                    await release.wait()
+
+            tasks = [asyncio.ensure_future(job()) for _ in range(10)]
+            await asyncio.sleep(0)
+            queued = len(limiter._waiters)
+            limiter._release()
+            woken = queued - len(limiter._waiters)
+            pending = [w for w in limiter._waiters if w.done()]
+            limiter._in_flight += 1  # undo the manual release
+            release.set()
+            await asyncio.gather(*tasks)
+            return queued, woken, pending
+
+        queued, woken, pending = asyncio.run(run())
+        self.assertEqual(queued, 8)
+        self.assertEqual(woken, 1)
+        self.assertEqual(pending, [])
+
+    def test_cancelled_waiter_passes_slot_on(self):
+        async def run():
+            limiter = _AdaptiveLimiter(1, 1, 1)
+            entered = []
+
+            async def job(name):
+                async with limiter.slot():
+                    entered.append(name)
+
+            limiter._in_flight = 1  # the only slot is taken
+            handed = asyncio.ensure_future(job('handed'))
+            queued = asyncio.ensure_future(job('queued'))
+            cancelled = asyncio.ensure_future(job('cancelled'))
+            last = asyncio.ensure_future(job('last'))
+            await asyncio.sleep(0)
+            cancelled.cancel()
+            # Hand the slot to the first waiter, then cancel it before
+            # it gets to run
+            limiter._release()
+            handed.cancel()
+            await asyncio.gather(
+                handed, queued, cancelled, last, return_exceptions=True
+            )
+            return entered, limiter
+
+        entered, limiter = asyncio.run(run())
+        self.assertEqual(entered, ['queued', 'last'])
+        self.assertEqual(limiter._in_flight, 0)
+        self.assertFalse(limiter._waiters)
+
+    def test_burst_of_429s_halves_limit_once(self):
+        async def run():
+            limiter = _AdaptiveLimiter(8, 1, 64)
+            started = asyncio.Event()
+            count = []
+
+            async def job():
+                async with limiter.slot():
+                    count.append(1)
+                    if len(count) == 8:
+                        started.set()
+                    await started.wait()
+                    raise RateLimitedError('429', 429)
+
+            await asyncio.gather(
+                *(job() for _ in range(8)), return_exceptions=True
+            )
+            return limiter.limit
+
+        self.assertEqual(asyncio.run(run()), 4)
+
+    def test_limit_stays_within_bounds(self):
+        async def run():
+            limiter = _AdaptiveLimiter(2, 2, 3)
+            for _ in range(3):
+                try:
+                    async with limiter.slot():
+                        raise RateLimitedError('429', 429)
+                except RateLimitedError:
+                    pass
+            low = limiter.limit
+            for _ in range(50):
+                async with limiter.slot():
+                    pass
+            return low, limiter.limit
+
+        self.assertEqual(asyncio.run(run()), (2, 3))
+
+
+class RetryDelayTest(unittest.TestCase):
+    """Which errors are retried, and how long each retry waits"""
+
+    def setUp(self):
+        self.downloader = InstagramDownloader(cache_size=0, max_retries=3)
+
+    def tearDown(self):
+        self.downloader.close()
+
+    def test_retry_after_is_honored_and_capped(self):
+        delay = self.downloader._retry_delay
+        self.assertEqual(delay(RateLimitedError('', 429, 7.0), 0), 7.0)
+        self.assertEqual(
+            delay(RateLimitedError('', 429, 3600.0), 0),
+            InstagramDownloader.MAX_RETRY_DELAY
+        )
+
+    def test_backoff_jitter_bounds(self):
+        delay = self.downloader._retry_delay
+        cases = (
+            (RateLimitedError('', 429), InstagramDownloader.RATE_LIMIT_BACKOFF),
+            (ServerError('', 503), InstagramDownloader.SERVER_ERROR_BACKOFF),
+        )
+        for error, base in cases:
+            for attempt in range(3):
+                ceiling = min(
+                    InstagramDownloader.MAX_RETRY_DELAY, base * 2 ** attempt
+                )
+                with self.subTest(error=type(error).__name__, attempt=attempt):
+                    for _ in range(200):
+                        self.assertTrue(0 <= delay(error, attempt) <= ceiling)
+
+    def test_backoff_ceiling_is_capped(self):
+        self.downloader.max_retries = 20
+        for _ in range(200):
+            self.assertLessEqual(
+                self.downloader._retry_delay(RateLimitedError('', 429), 19),
+                InstagramDownloader.MAX_RETRY_DELAY
+            )
+
+    def test_not_retried(self):
+        delay = self.downloader._retry_delay
+        self.assertIsNone(delay(RateLimitedError('', 403), 0))
+        self.assertIsNone(delay(RateLimitedError('', 429, 1.0), 3))
+        self.assertIsNone(delay(ServerError('', 500), 3))
+        self.downloader.max_retries = 0
+        self.assertIsNone(delay(ServerError('', 500), 0))
+
+
+class _PageHandler(BaseHTTPRequestHandler):
+    """Serves an og: page over keep-alive; /slow/ answers too late"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path.startswith('/slow/'):
+            time.sleep(0.5)
+        body = (
+            '<meta property="og:image" content="' + IMAGE_URL + '">'
+        ).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _PageServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # The client gives up on /slow/ before it is answered
+        pass
+
+
+class HttpClientConnectionTest(unittest.TestCase):
+    """The stdlib transport recovers from a failed kept-alive exchange"""
+
+    def setUp(self):
+        self.server = _PageServer(('127.0.0.1', 0), _PageHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.base = 'http://127.0.0.1:%d' % self.server.server_port
+        self.downloader = InstagramDownloader(cache_size=0, max_retries=0)
+        self.downloader.TIMEOUT = 0.2
+        self.downloader._fetch = self.downloader._fetch_with_http_client
+
+    def tearDown(self):
+        self.downloader.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_timeout_does_not_poison_connection(self):
+        html, _ = self.downloader._fetch_html(self.base + '/p/first/')
+        self.assertIn(IMAGE_URL.encode(), html)
+        with self.assertRaises(Exception):
+            self.downloader._fetch_html(self.base + '/slow/')
+        self.assertEqual(self.downloader._conns, {})
+        for _ in range(3):
+            html, _ = self.downloader._fetch_html(self.base + '/p/next/')
+            self.assertIn(IMAGE_URL.encode(), html)
+
+
+if __name__ == '__main__':
+    unittest.main()